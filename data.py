@@ -3,11 +3,13 @@ This module contains functions for deriving new FPL data set from existing ones.
 """
 
 import pandas as pd
-import datetime as dt
 import re
 from common import *
 from datadict.jupyter import DataDict
 
+next_n_gws_pattern = re.compile(r'Next (\d+) GWs', re.IGNORECASE)
+
+
 def get_team_fixture_scores(fixture_teams: pd.DataFrame, teams: pd.DataFrame) -> pd.DataFrame:
     """
     Converts the given fixture team stats (one row per fixture) to a data frame with one row for each fixture and team combination.
@@ -24,16 +26,18 @@ def get_team_fixture_scores(fixture_teams: pd.DataFrame, teams: pd.DataFrame) ->
     validate_df(fixture_teams, 'fixture_teams', ['Fixture ID', 'Game Week', 'Home Team Score', 'Away Team Score', 'Home Team ID', 'Away Team ID'])
     validate_df(teams, 'teams', ['Team Code', 'Team Short Name', 'Team Name'])
 
-    # Unfold data frame so that there a two rows for each fixture.
-    return (pd.melt(fixture_teams[['Fixture ID', 'Game Week', 'Home Team Score', 'Away Team Score', 'Home Team ID', 'Away Team ID']],
-                    id_vars=['Fixture ID', 'Game Week', 'Home Team Score', 'Away Team Score'],
-                    value_vars=['Home Team ID', 'Away Team ID'])
-            .rename(columns={'variable': 'Variable', 'value': 'Value'})
-            .sort_values(['Game Week'])
-            .assign(**{'Team Goals Scored': lambda df: df.apply(lambda row: row['Home Team Score'] if row['Variable'] == 'Home Team ID' else row['Away Team Score'], axis=1)})
-            .assign(**{'Team Goals Conceded': lambda df: df.apply(lambda row: row['Away Team Score'] if row['Variable'] == 'Home Team ID' else row['Home Team Score'], axis=1)})
-            .assign(**{'Is Home?': lambda df: df['Variable'] == 'Home Team ID'})
-            .rename(columns={'Value': 'Team ID'}).drop('Variable', axis=1)
+    # Unfold data frame so that there a two rows for each fixture, one from the point of view of each team.
+    fixture_scores = fixture_teams[['Fixture ID', 'Game Week', 'Home Team Score', 'Away Team Score']]
+    home = fixture_scores.assign(**{'Team ID': fixture_teams['Home Team ID'],
+                                    'Team Goals Scored': fixture_teams['Home Team Score'],
+                                    'Team Goals Conceded': fixture_teams['Away Team Score'],
+                                    'Is Home?': True})
+    away = fixture_scores.assign(**{'Team ID': fixture_teams['Away Team ID'],
+                                    'Team Goals Scored': fixture_teams['Away Team Score'],
+                                    'Team Goals Conceded': fixture_teams['Home Team Score'],
+                                    'Is Home?': False})
+
+    return (pd.concat([home, away], ignore_index=True)
             .merge(teams, left_on='Team ID', right_on='Team ID'))
 
 
@@ -49,23 +53,19 @@ def get_team_score_stats(team_fixture_scores: pd.DataFrame) -> pd.DataFrame:
     """
     validate_df(team_fixture_scores, 'team_fixture_scores', ['Team ID', 'Team Short Name', 'Is Home?', 'Team Goals Scored', 'Team Goals Conceded'])
 
+    # The team short name is determined by the team ID, so it is looked up once per team instead of being hashed as an extra group key.
+    team_short_names = team_fixture_scores.groupby('Team ID', sort=False)['Team Short Name'].first()
     team_score_stats = (team_fixture_scores
-                        .groupby(['Team ID', 'Team Short Name', 'Is Home?'])[['Team Goals Scored', 'Team Goals Conceded']]
+                        .groupby(['Team ID', 'Is Home?'], sort=False)[['Team Goals Scored', 'Team Goals Conceded']]
                         .sum()
                         .unstack(level=-1)
-                        .reset_index()
-                        .rename(columns={False: 'Away', True: 'Home'}))
-    team_score_stats.columns = [' '.join(col).strip() for col in team_score_stats.columns.values]
-    team_score_stats = (team_score_stats
-                        .set_index('Team ID')
-                        .rename(columns={'Team Goals Conceded Home': 'Total Team Goals Conceded Home',
-                                         'Team Goals Conceded Away': 'Total Team Goals Conceded Away',
-                                         'Team Goals Scored Home': 'Total Team Goals Scored Home',
-                                         'Team Goals Scored Away': 'Total Team Goals Scored Away'})
-                        .assign(**{'Total Team Goals Scored Ratio': lambda df: df['Total Team Goals Scored Away'] / df['Total Team Goals Scored Home']})
-                        .assign(**{'Total Team Goals Conceded Ratio': lambda df: df['Total Team Goals Conceded Away'] / df['Total Team Goals Conceded Home']})
-                        .assign(**{'Total Team Goals Scored': lambda df: df['Total Team Goals Scored Away'] + df['Total Team Goals Scored Home']})
-                        .assign(**{'Total Team Goals Conceded': lambda df: df['Total Team Goals Conceded Away'] + df['Total Team Goals Conceded Home']}))
+                        .reindex(columns=[False, True], level=-1))
+    team_score_stats.columns = [f'Total {stat} {"Home" if is_home else "Away"}' for stat, is_home in team_score_stats.columns]
+    team_score_stats.insert(0, 'Team Short Name', team_short_names)
+    team_score_stats['Total Team Goals Scored Ratio'] = team_score_stats['Total Team Goals Scored Away'] / team_score_stats['Total Team Goals Scored Home']
+    team_score_stats['Total Team Goals Conceded Ratio'] = team_score_stats['Total Team Goals Conceded Away'] / team_score_stats['Total Team Goals Conceded Home']
+    team_score_stats['Total Team Goals Scored'] = team_score_stats['Total Team Goals Scored Away'] + team_score_stats['Total Team Goals Scored Home']
+    team_score_stats['Total Team Goals Conceded'] = team_score_stats['Total Team Goals Conceded Away'] + team_score_stats['Total Team Goals Conceded Home']
 
     return team_score_stats
 
@@ -87,13 +87,12 @@ def get_next_gw_counts(next_gws: list, next_gw: int, total_gws: int) -> dict:
     for next_gw in next_gws:
         if next_gw == 'Next GW':
             next_gw_counts[next_gw] = min(1, remain_gws)
-
-        if next_gw == 'GWs To End':
+        elif next_gw == 'GWs To End':
             next_gw_counts[next_gw] = remain_gws
-
-        gw = re.search(r'Next (\d+) GWs', next_gw, re.IGNORECASE)
-        if gw:
-            next_gw_counts[next_gw] = min(int(gw.group(1)), remain_gws)
+        else:
+            gw = next_n_gws_pattern.match(next_gw)
+            if gw:
+                next_gw_counts[next_gw] = min(int(gw.group(1)), remain_gws)
 
     return next_gw_counts
 
@@ -115,13 +114,19 @@ def calc_eps_for_next_gws(player_gw_eps: pd.DataFrame, next_gws: list, next_gw:
 
     current_df = df[df['Game Week'] == next_gw]
     row = current_df.iloc[0]
+    result = row.to_dict()
+    # The data frame is sorted by game week, so the rows of each time horizon form a contiguous slice.
+    gws = df['Game Week'].values
+    eps = df['Expected Points'].values * df['Chance Avail Next GW'].values / 100
+    fixture_names = df['Fixture Short Name Difficulty'].tolist()
+    start = np.searchsorted(gws, next_gw, 'left')
     for next_gw_post_fix, next_gw_count in next_gw_counts.items():
-        future_df = df[(df['Game Week'] >= next_gw) & (df['Game Week'] < next_gw + next_gw_count)]
-        row['Expected Points ' + next_gw_post_fix] = (future_df['Expected Points'] * future_df['Chance Avail Next GW'] / 100).sum()
+        end = np.searchsorted(gws, next_gw + next_gw_count, 'left')
+        result['Expected Points ' + next_gw_post_fix] = np.nansum(eps[start:end])
         if next_gw_post_fix != 'GWs To End':
-            row['Fixtures ' + next_gw_post_fix] = value_or_default(future_df['Fixture Short Name Difficulty'].str.cat(sep=', '))
+            result['Fixtures ' + next_gw_post_fix] = value_or_default(', '.join(name for name in fixture_names[start:end] if isinstance(name, str)))
 
-    return row
+    return pd.Series(result, name=row.name)
 
 
 def calc_eps(player_fixture_stats: pd.DataFrame) -> pd.Series:
@@ -130,15 +135,28 @@ def calc_eps(player_fixture_stats: pd.DataFrame) -> pd.Series:
 
 
 def calc_player_fixture_stats(players_fixture_team_points: pd.DataFrame):
-    return (players_fixture_team_points
-        .sort_values('Kick Off Time')
-        .assign(**{'GW Played': lambda df: df['Game Minutes Played'] > 0})
-        .assign(**{'GWs Played To GW': lambda df: df.groupby('Player ID')['GW Played'].apply(lambda x: x.shift().cumsum().fillna(method='ffill'))})
-        .assign(**{'Total Points To GW': lambda df: df.groupby('Player ID')['Game Total Points'].apply(lambda x: x.shift().cumsum().fillna(method='ffill'))})
-        .assign(**{'Total Opp Team Goals Scored Diff': lambda df: df['Total Team Goals Scored']-df['Total Opp Team Goals Scored']})
-        .assign(**{'Avg Points To GW': lambda df: df.groupby('Player ID')['Game Total Points'].apply(lambda x: x.shift().rolling(10, min_periods=1).mean().fillna(method='ffill'))})
-        .assign(**{'Avg Minutes Played Recently To GW': lambda df: df.groupby('Player ID')['Game Minutes Played'].apply(lambda x: x.shift().rolling(10, min_periods=1).mean())})
-        .assign(**{'Avg Points Opp Points Adj To GW': lambda df: df.apply(lambda row: row['Avg Points To GW']*row['Team Total Points']/row['Opp Team Total Points'], axis=1)}))
+    # The stats below only require the fixtures of each player to be in kick off order, so sorting is skipped if the data is already sorted.
+    player_fixture_stats = players_fixture_team_points
+    if not player_fixture_stats['Kick Off Time'].is_monotonic_increasing:
+        player_fixture_stats = player_fixture_stats.sort_values('Kick Off Time')
+
+    player_fixture_stats = player_fixture_stats.assign(**{'GW Played': lambda df: df['Game Minutes Played'] > 0})
+
+    # Shifts the player stats once so that the stats to a game week only include previous game weeks, and
+    # then calculates the cumulative and rolling stats for all columns in one grouped operation each.
+    # The player grouper works whether Player ID is a column or an index level.
+    player_groups = player_fixture_stats.groupby('Player ID').ngroup()
+    prev_stats = player_fixture_stats.groupby(player_groups)[['GW Played', 'Game Total Points', 'Game Minutes Played']].shift().astype(float)
+    prev_sums = prev_stats[['GW Played', 'Game Total Points']].groupby(player_groups).cumsum().groupby(player_groups).ffill()
+    prev_avgs = prev_stats[['Game Total Points', 'Game Minutes Played']].groupby(player_groups).rolling(10, min_periods=1).mean().droplevel(0)
+
+    return (player_fixture_stats
+        .assign(**{'GWs Played To GW': prev_sums['GW Played'],
+                   'Total Points To GW': prev_sums['Game Total Points'],
+                   'Total Opp Team Goals Scored Diff': lambda df: df['Total Team Goals Scored']-df['Total Opp Team Goals Scored'],
+                   'Avg Points To GW': prev_avgs['Game Total Points'].groupby(player_groups).ffill(),
+                   'Avg Minutes Played Recently To GW': prev_avgs['Game Minutes Played'],
+                   'Avg Points Opp Points Adj To GW': lambda df: df['Avg Points To GW']*df['Team Total Points']/df['Opp Team Total Points']}))
 
 
 def get_player_teams(players: pd.DataFrame, teams: pd.DataFrame, dd: DataDict):
@@ -146,42 +164,39 @@ def get_player_teams(players: pd.DataFrame, teams: pd.DataFrame, dd: DataDict):
     .reset_index(drop=False)
     .merge(teams, left_on='Player Team ID', right_on='Team ID')
     .set_index('Player ID')
-    .assign(**{'Long Name': lambda df: df['First Name']+' '+df['Last Name']})
-    .assign(**{'Long Name and Team': lambda df: df['Long Name']+' ('+df['Team Name']+')'})
-    .assign(**{'Name and Short Team': lambda df: df['Name']+' ('+df['Team Short Name']+')'})
+    .assign(**{'Long Name': lambda df: df['First Name']+' '+df['Last Name'],
+               'Long Name and Team': lambda df: df['Long Name']+' ('+df['Team Name']+')',
+               'Name and Short Team': lambda df: df['Name']+' ('+df['Team Short Name']+')'})
     .pipe(dd.reorder))
 
 def get_fixture_teams(fixtures: pd.DataFrame, teams: pd.DataFrame, dd: DataDict) -> pd.DataFrame:
     return (fixtures
          .reset_index()
-         .merge(teams[['Team Name', 'Team Short Name']]
-                    .rename(columns={'Team Name': 'Team Name Home', 'Team Short Name': 'Team Short Name Home'}),
-                left_on='Home Team ID',
-                right_on='Team ID', suffixes=(False, False))
-         .merge(teams[['Team Name', 'Team Short Name']]
-                    .rename(columns={'Team Name': 'Team Name Away', 'Team Short Name': 'Team Short Name Away'}),
-                left_on='Away Team ID',
-                right_on='Team ID', suffixes=(False, False))
+         .assign(**{'Team Name Home': lambda df: df['Home Team ID'].map(teams['Team Name']),
+                    'Team Short Name Home': lambda df: df['Home Team ID'].map(teams['Team Short Name']),
+                    'Team Name Away': lambda df: df['Away Team ID'].map(teams['Team Name']),
+                    'Team Short Name Away': lambda df: df['Away Team ID'].map(teams['Team Short Name'])})
          .pipe(dd.reorder))
 
-def get_news(row: pd.Series) -> str:
+def get_news(players: pd.DataFrame) -> pd.Series:
     '''Derives the text for the News column.'''
-    if pd.isnull(row['news']) or row['news'] == '': return None
-    date_part = '' if pd.isnull(row['news_added'] or row['news_added'] == 'None') else ' ('+dt.datetime.strftime(dt.datetime.strptime(re.sub(r'\.\d+', '', row['news_added']), '%Y-%m-%dT%H:%M:%SZ'), '%d %b %Y')+')'
-    return str(row['news'])+date_part
+    news = players['news'].fillna('').astype(str)
+    news_added = pd.to_datetime(players['news_added'].astype(str).str.replace(r'\.\d+', '', regex=True), format='%Y-%m-%dT%H:%M:%SZ', errors='coerce')
+    date_part = (' ('+news_added.dt.strftime('%d %b %Y')+')').fillna('')
+    return pd.Series(np.where(news == '', None, news+date_part), index=players.index)
 
 
 def prepare_players(players_raw: pd.DataFrame, dd: DataDict) -> pd.DataFrame:
     return (players_raw
         .pipe(dd.remap, data_set='player')
-        .assign(**{'ICT Index': lambda df: pd.to_numeric(df['ICT Index'])})
-        .assign(**{'Field Position': lambda df: df['Field Position ID'].map(lambda x: position_by_type[x])})
-        .assign(**{'Current Cost': lambda df: df['now_cost']/10})
-        .assign(**{'Minutes Percent': lambda df: df['Minutes Played']/df['Minutes Played'].max()*100})
-        .assign(**{'News And Date': lambda df: df.apply(lambda row: get_news(row), axis=1)})
-        .assign(**{'Percent Selected': lambda df: pd.to_numeric(df['Percent Selected'])})
-        .assign(**{'Chance Avail This GW': lambda df: df['Chance Avail This GW'].map(lambda x: x if not pd.isnull(x) else 100)})
-        .assign(**{'Chance Avail Next GW': lambda df: df['Chance Avail Next GW'].map(lambda x: x if not pd.isnull(x) else 100)})
+        .assign(**{'ICT Index': lambda df: pd.to_numeric(df['ICT Index']),
+                   'Field Position': lambda df: df['Field Position ID'].map(position_by_type),
+                   'Current Cost': lambda df: df['now_cost']/10,
+                   'Minutes Percent': lambda df: df['Minutes Played']/df['Minutes Played'].max()*100,
+                   'News And Date': lambda df: get_news(df),
+                   'Percent Selected': lambda df: pd.to_numeric(df['Percent Selected']),
+                   'Chance Avail This GW': lambda df: df['Chance Avail This GW'].fillna(100),
+                   'Chance Avail Next GW': lambda df: df['Chance Avail Next GW'].fillna(100)})
         .rename_axis('Player ID')
         .pipe(dd.reorder))
 
@@ -194,8 +209,8 @@ def prepare_players_history(players_history_raw: pd.DataFrame, dd: DataDict) ->
     return (players_history_raw
         .pipe(dd.remap, 'player_hist')
         .rename_axis(['Player ID', 'Fixture ID'])
-        .assign(**{'Game Cost': lambda df: df['value']/10})
-        .assign(**{'Game ICT Index': lambda df: pd.to_numeric(df['Game ICT Index'])}))
+        .assign(**{'Game Cost': lambda df: df['value']/10,
+                   'Game ICT Index': lambda df: pd.to_numeric(df['Game ICT Index'])}))
 
 def prepare_teams(teams_raw: pd.DataFrame, dd: DataDict) -> pd.DataFrame:
     return (teams_raw
@@ -225,26 +240,24 @@ def proj_to_gw(players_fixture_team_eps: pd.DataFrame) -> pd.DataFrame:
         return 'last'
 
     def fill_missing_gws(players_gw_team_eps: pd.DataFrame) -> pd.DataFrame:
-        return (players_gw_team_eps
-                # Fills some columns with the value of the last game week if there is no fixture for a player in a particular game week.
-                .assign(**players_gw_team_eps
-                        .groupby('Player ID')[
-            'Player Team ID', 'Name', 'Name and Short Team', 'News And Date', 'Field Position ID', 'Field Position', 'Team Short Name', 'Minutes Played', 'Minutes Percent', 'Current Cost', 'Total Points', 'Total Points Consistency']
-                        .apply(lambda x: x.fillna(method='ffill')).to_dict('series'))
-                # Fills some columns with 0 if there is no fixture for a player in a particular game week.
-                .assign(**players_gw_team_eps
-                        .groupby('Player ID')['Expected Points NN', 'Expected Points Calc', 'Expected Points', 'Chance Avail This GW', 'Chance Avail Next GW']
-                        .apply(lambda x: x.fillna(0.0)).to_dict('series')))
-
-    # Creates a data frame with a row of every game week/player ID combination. This is required to deal with game weeks that have double or missing fixtures.
+        # Fills some columns with the value of the last game week if there is no fixture for a player in a particular game week.
+        ffill_cols = ['Player Team ID', 'Name', 'Name and Short Team', 'News And Date', 'Field Position ID', 'Field Position', 'Team Short Name', 'Minutes Played', 'Minutes Percent', 'Current Cost', 'Total Points', 'Total Points Consistency']
+        players_gw_team_eps[ffill_cols] = players_gw_team_eps.groupby(level='Player ID', sort=False)[ffill_cols].ffill()
+
+        # Fills some columns with 0 if there is no fixture for a player in a particular game week.
+        zero_cols = ['Expected Points NN', 'Expected Points Calc', 'Expected Points', 'Chance Avail This GW', 'Chance Avail Next GW']
+        players_gw_team_eps[zero_cols] = players_gw_team_eps[zero_cols].fillna(0.0)
+
+        return players_gw_team_eps
+
+    # Creates an index with an entry for every game week/player ID combination. This is required to deal with game weeks that have double or missing fixtures.
     gws = pd.Series(range(1, players_fixture_team_eps['Game Week'].max() + 1))
     player_gws_index = pd.MultiIndex.from_product([players_fixture_team_eps.index.unique(level=0), gws], names=['Player ID', 'Game Week'])
-    player_gws = pd.DataFrame(index=player_gws_index)
 
     # Projects from fixtures to game weeks.
+    agg_funcs = {col: proj_to_gw_func(players_fixture_team_eps[col]) for col in players_fixture_team_eps.columns if col != 'Game Week'}
     return (players_fixture_team_eps
-            .groupby(['Player ID', 'Game Week'])
-            .agg({col: proj_to_gw_func(players_fixture_team_eps[col]) for col in players_fixture_team_eps.columns})
-            .drop(columns=['Game Week'])
-            .merge(player_gws, left_index=True, right_index=True, how='right', suffixes=(False, False))
+            .groupby(['Player ID', 'Game Week'], observed=True, sort=False)
+            .agg(agg_funcs)
+            .reindex(player_gws_index)
             .pipe(fill_missing_gws))
@@ -61,6 +61,18 @@ class TestGetNextGwCounts(unittest.TestCase):
         self.assertDictEqual(next_gw_counts, {'Next GW': 0, 'Next 7 GWs': 0, 'GWs To End': 0})
 
 
+class TestGetNews(unittest.TestCase):
+    """
+    Unit tests the get_news function.
+    """
+
+    def test_get_news(self):
+        players = pd.DataFrame({'news': ['Knee injury', 'Suspended', 'Ill', '', np.nan],
+                                'news_added': ['2019-08-10T18:00:00.123456Z', None, np.nan, '2019-08-10T18:00:00Z', np.nan]})
+
+        self.assertListEqual(get_news(players).tolist(), ['Knee injury (10 Aug 2019)', 'Suspended', 'Ill', None, None])
+
+
 class TestCalcEps(unittest.TestCase):
     """
     Unit tests the get_next_gw_counts function.
@@ -91,6 +103,15 @@ class TestCalcPlayerFixtureStats(unittest.TestCase):
                            player_fixture_stats,
                            check_dtype=False)
 
+    def test_calc_player_fixture_stats_player_id_column(self):
+        player_fixture_stats = (pd.read_csv(self.test_file)
+                                .pipe(calc_player_fixture_stats)
+                                .reset_index(drop=True))
+
+        assert_frame_equal(pd.read_csv('assert_calc_player_fixture_stats.csv'),
+                           player_fixture_stats,
+                           check_dtype=False)
+
 
 class TestProjToGw(unittest.TestCase):
     """